@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+WPS Excel修复工具 - 输出模式基准测试
+对比浮动图片(drawing)与单元格内图片(richdata)两种输出的文件大小和打开耗时
+
+用法: python benchmark.py input.xlsx [--excel]
+    --excel  额外通过Excel COM接口测量真实打开耗时（仅Windows且需安装pywin32）
+"""
+
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+import zipfile
+
+import openpyxl
+
+from wps_repair_standalone import PreciseSafeWPSExcelFixer
+
+
+def run_repair(input_path, output_path, output_mode):
+    """执行一次修复，屏蔽修复过程的逐单元格日志，返回耗时（秒）"""
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = PreciseSafeWPSExcelFixer(input_path).fix_excel_file_precise_safe(
+            output_path, output_mode=output_mode)
+    if not result:
+        raise RuntimeError(f"{output_mode} 模式修复失败")
+    return time.perf_counter() - start
+
+
+def part_sizes(output_path):
+    """统计绘图部件和richData部件解压后的总字节数"""
+    drawing_size = richdata_size = 0
+    with zipfile.ZipFile(output_path) as zfile:
+        for info in zfile.infolist():
+            if info.filename.startswith('xl/drawings/'):
+                drawing_size += info.file_size
+            elif info.filename.startswith('xl/richData/') or info.filename == 'xl/metadata.xml':
+                richdata_size += info.file_size
+    return drawing_size, richdata_size
+
+
+def openpyxl_open_time(output_path, repeat=3):
+    """用openpyxl加载输出文件的平均耗时，作为解析开销的近似"""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        openpyxl.load_workbook(output_path).close()
+    return (time.perf_counter() - start) / repeat
+
+
+def excel_open_time(output_path):
+    """通过Excel COM接口测量真实打开耗时，环境不支持时返回None"""
+    try:
+        import win32com.client
+    except ImportError:
+        return None
+
+    excel = win32com.client.DispatchEx('Excel.Application')
+    excel.Visible = False
+    excel.DisplayAlerts = False
+    try:
+        start = time.perf_counter()
+        workbook = excel.Workbooks.Open(os.path.abspath(output_path), ReadOnly=True)
+        excel.CalculateUntilAsyncQueriesDone()
+        elapsed = time.perf_counter() - start
+        workbook.Close(SaveChanges=False)
+        return elapsed
+    finally:
+        excel.Quit()
+
+
+def main():
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    if not args:
+        print(__doc__)
+        return 1
+    input_path = args[0]
+    measure_excel = '--excel' in sys.argv[1:]
+
+    print(f"=== 输出模式基准测试: {input_path} ===")
+    rows = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for output_mode in PreciseSafeWPSExcelFixer.OUTPUT_MODES:
+            output_path = os.path.join(temp_dir, f"{output_mode}.xlsx")
+            repair_time = run_repair(input_path, output_path, output_mode)
+            drawing_size, richdata_size = part_sizes(output_path)
+            row = {
+                'mode': output_mode,
+                'repair': repair_time,
+                'size': os.path.getsize(output_path),
+                'drawing': drawing_size,
+                'richdata': richdata_size,
+                'openpyxl': openpyxl_open_time(output_path),
+                'excel': excel_open_time(output_path) if measure_excel else None,
+            }
+            rows.append(row)
+
+    print(f"{'模式':<10}{'修复耗时':>10}{'文件大小':>12}{'绘图XML':>12}{'richData':>12}"
+          f"{'openpyxl打开':>14}{'Excel打开':>12}")
+    for row in rows:
+        excel = f"{row['excel']:.2f}s" if row['excel'] is not None else '-'
+        print(f"{row['mode']:<10}{row['repair']:>9.2f}s{row['size'] / 1024:>10.1f}KB"
+              f"{row['drawing'] / 1024:>10.1f}KB{row['richdata'] / 1024:>10.1f}KB"
+              f"{row['openpyxl']:>13.2f}s{excel:>12}")
+
+    if measure_excel and rows[0]['excel'] is None:
+        print("\n提示: 未检测到pywin32/Excel，已跳过Excel打开耗时测量")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,513 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+WPS Excel修复工具 - 测试
+运行: python -m pytest -q
+"""
+
+import gc
+import io
+import os
+import posixpath
+import re
+import struct
+import warnings
+import tempfile
+import zipfile
+
+import openpyxl
+import pytest
+import xml.etree.ElementTree as ET
+from openpyxl.worksheet import _writer as openpyxl_worksheet_writer
+from PIL import Image as PILImage
+
+from wps_repair_standalone import (
+    DispimgCellTable, MappedXlsxReader, PreciseSafeWPSExcelFixer, repair_xlsx_bytes)
+
+
+def _make_wps_workbook(sheet_rows, image_count=3):
+    """生成WPS风格的xlsx字节：sheet_rows为{工作表名: DISPIMG行数}，图片按行轮流引用"""
+    workbook = openpyxl.Workbook()
+    workbook.remove(workbook.active)
+    for sheet_name, rows in sheet_rows.items():
+        sheet = workbook.create_sheet(sheet_name)
+        for row in range(1, rows + 1):
+            sheet.cell(row=row, column=1, value=f'{sheet_name}-{row}')
+            sheet.cell(row=row, column=2, value=f'=_xlfn.DISPIMG("ID_{row % image_count}",1)')
+    package = io.BytesIO()
+    workbook.save(package)
+
+    cell_images = []
+    relationships = []
+    for i in range(image_count):
+        cell_images.append(
+            f'<etc:cellImage><xdr:pic><xdr:nvPicPr><xdr:cNvPr id="{i + 1}" name="ID_{i}"/>'
+            f'<xdr:cNvPicPr/></xdr:nvPicPr><xdr:blipFill><a:blip r:embed="rId{i + 1}"/>'
+            '</xdr:blipFill></xdr:pic></etc:cellImage>')
+        relationships.append(
+            f'<Relationship Id="rId{i + 1}" '
+            'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/image" '
+            f'Target="media/image{i + 1}.png"/>')
+
+    output = io.BytesIO()
+    with zipfile.ZipFile(package) as source, zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED) as target:
+        for name in source.namelist():
+            target.writestr(name, source.read(name))
+        for i in range(image_count):
+            image = io.BytesIO()
+            PILImage.new('RGB', (40 + i * 10, 30 + i * 5), (i * 60, 100, 200)).save(image, 'PNG')
+            target.writestr(f'xl/media/image{i + 1}.png', image.getvalue())
+        target.writestr(
+            'xl/cellimages.xml',
+            '<etc:cellImages xmlns:etc="http://www.wps.cn/officeDocument/2017/etCustomData" '
+            'xmlns:xdr="http://schemas.openxmlformats.org/drawingml/2006/spreadsheetDrawing" '
+            'xmlns:a="http://schemas.openxmlformats.org/drawingml/2006/main" '
+            'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+            f'{"".join(cell_images)}</etc:cellImages>')
+        target.writestr(
+            'xl/_rels/cellimages.xml.rels',
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            f'{"".join(relationships)}</Relationships>')
+    return output.getvalue()
+
+
+# ========== MappedXlsxReader ==========
+
+def _write_zip(path, entries):
+    """entries: [(文件名, 数据, 压缩方式)]"""
+    with zipfile.ZipFile(path, 'w') as zfile:
+        for name, data, compress_type in entries:
+            zfile.writestr(zipfile.ZipInfo(name), data, compress_type=compress_type)
+
+
+def _patch_central_directory(path, name, offset, fmt, value):
+    """修改中央目录中某条目的字段（offset为相对中央目录记录起点的偏移）"""
+    data = bytearray(path.read_bytes())
+    encoded_name = name.encode('utf-8')
+    position = 0
+    while True:
+        position = data.index(b'PK\x01\x02', position)
+        name_len = struct.unpack_from('<H', data, position + 28)[0]
+        if data[position + 46:position + 46 + name_len] == encoded_name:
+            break
+        position += 4
+    struct.pack_into(fmt, data, position + offset, value)
+    path.write_bytes(bytes(data))
+
+
+def test_stored_entry_is_zero_copy_memoryview(tmp_path):
+    path = tmp_path / 'stored.zip'
+    _write_zip(path, [('xl/media/image1.png', b'stored-image-data', zipfile.ZIP_STORED)])
+
+    with MappedXlsxReader(str(path)) as reader:
+        data = reader.read('xl/media/image1.png')
+        assert isinstance(data, memoryview)
+        assert data == b'stored-image-data'
+        data.release()
+
+
+def test_deflated_entry_is_complete_and_streams_in_chunks(tmp_path):
+    payload = b''.join(b'%08d-row-data\n' % i for i in range(200000))
+    path = tmp_path / 'deflated.zip'
+    _write_zip(path, [('xl/worksheets/sheet1.xml', payload, zipfile.ZIP_DEFLATED)])
+
+    with MappedXlsxReader(str(path)) as reader:
+        assert reader.read('xl/worksheets/sheet1.xml') == payload
+
+        chunks = list(reader.iter_chunks('xl/worksheets/sheet1.xml', chunk_size=4096))
+        assert len(chunks) > 1
+        assert all(len(chunk) < len(payload) for chunk in chunks)
+        assert b''.join(chunks) == payload
+
+
+@pytest.mark.parametrize('compress_type', [zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED])
+def test_crc_mismatch_raises_bad_zip_file(tmp_path, compress_type):
+    path = tmp_path / 'crc.zip'
+    _write_zip(path, [('xl/cellimages.xml', b'<cellImages/>' * 100, compress_type)])
+    # 中央目录记录中CRC-32位于第16字节
+    _patch_central_directory(path, 'xl/cellimages.xml', 16, '<I', 0x12345678)
+
+    with MappedXlsxReader(str(path)) as reader:
+        with pytest.raises(zipfile.BadZipFile):
+            reader.read('xl/cellimages.xml')
+        with pytest.raises(zipfile.BadZipFile):
+            b''.join(reader.iter_chunks('xl/cellimages.xml'))
+
+
+def test_unsupported_compression_falls_back_to_zipfile(tmp_path):
+    payload = b'bzip2 compressed entry' * 50
+    path = tmp_path / 'bzip2.zip'
+    _write_zip(path, [('xl/media/image1.bmp', payload, zipfile.ZIP_BZIP2)])
+
+    with MappedXlsxReader(str(path)) as reader:
+        data = reader.read('xl/media/image1.bmp')
+        assert isinstance(data, bytes)
+        assert data == payload
+        assert b''.join(reader.iter_chunks('xl/media/image1.bmp')) == payload
+
+
+def test_encrypted_entry_falls_back_to_zipfile(tmp_path):
+    path = tmp_path / 'encrypted.zip'
+    _write_zip(path, [('xl/media/image1.png', b'secret', zipfile.ZIP_STORED)])
+    # 中央目录记录中通用标志位于第8字节，bit 0表示加密
+    _patch_central_directory(path, 'xl/media/image1.png', 8, '<H', 0x1)
+
+    with MappedXlsxReader(str(path)) as reader:
+        # 交给zipfile处理，zipfile对无密码的加密条目报错
+        with pytest.raises(RuntimeError, match='encrypted'):
+            reader.read('xl/media/image1.png')
+
+
+
+@pytest.mark.parametrize('content', [b'abc', b'not a zip file' * 100], ids=['short', 'long'])
+def test_non_zip_input_raises_bad_zip_file_without_leaking(tmp_path, content):
+    path = tmp_path / 'broken.xlsx'
+    path.write_bytes(content)
+
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        with pytest.raises(zipfile.BadZipFile):
+            MappedXlsxReader(str(path))
+        gc.collect()
+    assert not [w for w in caught if issubclass(w.category, ResourceWarning)]
+
+
+
+# ========== DispimgCellTable ==========
+
+def test_cell_table_sheet_spans_skip_sheets_without_records():
+    table = DispimgCellTable()
+    first = table.add_sheet('S0')
+    table.append(first, 1, 2, 'ID_A')
+    table.append(first, 3, 2, 'ID_B')
+    table.add_sheet('Empty')
+    last = table.add_sheet('S2')
+    table.append(last, 5, 4, 'ID_A')
+
+    assert table.sheets() == [('S0', 0, 2), ('S2', 2, 3)]
+    assert list(table.records(*table.sheets()[1][1:])) == [(5, 4, 'ID_A')]
+    assert list(table.records()) == [(1, 2, 'ID_A'), (3, 2, 'ID_B'), (5, 4, 'ID_A')]
+
+
+def test_cell_table_truncate_rolls_back_failed_sheet():
+    table = DispimgCellTable()
+    first = table.add_sheet('S0')
+    table.append(first, 1, 1, 'ID_A')
+    failed = table.add_sheet('Broken')
+    sheet_start = len(table)
+    table.append(failed, 2, 2, 'ID_B')
+    table.append(failed, 3, 3, 'ID_C')
+
+    table.truncate(sheet_start)
+
+    assert len(table) == 1
+    assert table.sheets() == [('S0', 0, 1)]
+    assert list(table.records()) == [(1, 1, 'ID_A')]
+    # 列数组长度保持一致，之后的工作表可以继续追加
+    second = table.add_sheet('S2')
+    table.append(second, 4, 4, 'ID_A')
+    assert table.sheets() == [('S0', 0, 1), ('S2', 1, 2)]
+
+
+def test_cell_table_interns_image_ids():
+    table = DispimgCellTable()
+    sheet = table.add_sheet('S0')
+    for row in range(1, 7):
+        table.append(sheet, row, 1, f'ID_{row % 2}')
+
+    assert table.image_ids == ['ID_1', 'ID_0']
+    assert list(table.image_indexes) == [0, 1, 0, 1, 0, 1]
+    assert [image_id for _, _, image_id in table.records()] == ['ID_1', 'ID_0'] * 3
+
+
+def test_analyze_dispimg_cells_reports_one_based_coordinates():
+    workbook = openpyxl.Workbook()
+    first = workbook.active
+    first.title = 'First'
+    first['A1'] = 'title'
+    first['D7'] = '=_xlfn.DISPIMG("ID_X",1)'
+    first['B3'] = '=_xlfn.DISPIMG("ID_Y",1)'
+    workbook.create_sheet('Plain')['A1'] = 'no images'
+    workbook.create_sheet('Second')['A1'] = '=_xlfn.DISPIMG("ID_X",1)'
+    package = io.BytesIO()
+    workbook.save(package)
+
+    fixer = PreciseSafeWPSExcelFixer(package.getvalue())
+    try:
+        table = fixer.analyze_dispimg_cells()
+    finally:
+        fixer.close()
+
+    assert table.sheets() == [('First', 0, 2), ('Second', 2, 3)]
+    assert list(table.records()) == [(3, 2, 'ID_Y'), (7, 4, 'ID_X'), (1, 1, 'ID_X')]
+    assert table.image_ids == ['ID_Y', 'ID_X']
+
+
+# ========== 内存中修复 ==========
+
+@pytest.mark.parametrize('output_mode', ['drawing', 'richdata'])
+def test_repair_xlsx_bytes_creates_no_temporary_files(tmp_path, monkeypatch, output_mode):
+    source = _make_wps_workbook({'S0': 4, 'S1': 4, 'S2': 4})
+    # 临时目录不可用时，任何临时文件的创建都会失败
+    monkeypatch.setattr(tempfile, 'tempdir', str(tmp_path / 'missing'))
+    temp_files_before = list(openpyxl_worksheet_writer.ALL_TEMP_FILES)
+
+    fixed = repair_xlsx_bytes(source, output_mode=output_mode)
+
+    assert fixed is not None
+    assert openpyxl_worksheet_writer.ALL_TEMP_FILES == temp_files_before
+    workbook = openpyxl.load_workbook(io.BytesIO(fixed))
+    assert workbook.sheetnames == ['S0', 'S1', 'S2']
+    assert all(sheet['B1'].value != '=_xlfn.DISPIMG("ID_1",1)' for sheet in workbook)
+
+
+
+def test_repair_xlsx_bytes_returns_input_when_nothing_to_fix():
+    workbook = openpyxl.Workbook()
+    workbook.active['A1'] = 'plain value'
+    package = io.BytesIO()
+    workbook.save(package)
+
+    assert repair_xlsx_bytes(package.getvalue()) == package.getvalue()
+    package.seek(0)
+    assert repair_xlsx_bytes(package) == package.getvalue()
+
+
+def test_repair_xlsx_bytes_raises_on_failure():
+    with pytest.raises(RuntimeError):
+        repair_xlsx_bytes(b'not an xlsx file' * 10)
+
+    # 有DISPIMG公式但缺少cellimages映射，无法修复
+    workbook = openpyxl.Workbook()
+    workbook.active['A1'] = '=_xlfn.DISPIMG("ID_0",1)'
+    package = io.BytesIO()
+    workbook.save(package)
+    with pytest.raises(RuntimeError):
+        repair_xlsx_bytes(package.getvalue())
+
+
+@pytest.mark.parametrize('source, expected', [
+    (os.path.join('reports.xlsx', 'data.xlsx'), os.path.join('reports.xlsx', 'data_fixed.xlsx')),
+    (os.path.join('exports', 'Sheet.XLSX'), os.path.join('exports', 'Sheet_fixed.XLSX')),
+    (os.path.join('a.xlsx.d', 'noext'), os.path.join('a.xlsx.d', 'noext_fixed.xlsx')),
+])
+def test_default_output_path_only_changes_the_file_name(source, expected):
+    assert PreciseSafeWPSExcelFixer.default_output_path(source) == expected
+
+
+# ========== 分片处理 ==========
+
+def _image_anchors(path):
+    """{工作表名: [(行, 列, 宽EMU, 高EMU)]}"""
+    workbook = openpyxl.load_workbook(path)
+    return {
+        sheet.title: sorted((image.anchor._from.row, image.anchor._from.col,
+                             image.anchor.ext.cx, image.anchor.ext.cy) for image in sheet._images)
+        for sheet in workbook
+    }
+
+
+def test_sharded_repair_matches_serial(tmp_path):
+    source = tmp_path / 'source.xlsx'
+    source.write_bytes(_make_wps_workbook({'S0': 5, 'S1': 6, 'S2': 7}))
+
+    serial = PreciseSafeWPSExcelFixer(str(source)).fix_excel_file_precise_safe(str(tmp_path / 'serial.xlsx'))
+    sharded = PreciseSafeWPSExcelFixer(str(source)).fix_excel_file_precise_safe(
+        str(tmp_path / 'sharded.xlsx'), shard_sheets=True, max_workers=2)
+
+    assert _image_anchors(sharded) == _image_anchors(serial)
+    with zipfile.ZipFile(sharded) as package:
+        assert package.testzip() is None
+        # 分片生成的绘图共享同一份图片，不再按单元格重复写入
+        assert len([name for name in package.namelist() if name.startswith('xl/media/')]) == 3
+
+
+
+def test_serial_repair_extracts_each_cell_image_once(tmp_path, monkeypatch):
+    source = tmp_path / 'source.xlsx'
+    source.write_bytes(_make_wps_workbook({'S0': 5, 'S1': 4}))
+    extracted = []
+    extract = PreciseSafeWPSExcelFixer.extract_image_from_xlsx
+
+    def counting_extract(self, image_path):
+        extracted.append(image_path)
+        return extract(self, image_path)
+
+    monkeypatch.setattr(PreciseSafeWPSExcelFixer, 'extract_image_from_xlsx', counting_extract)
+    output = PreciseSafeWPSExcelFixer(str(source)).fix_excel_file_precise_safe(str(tmp_path / 'out.xlsx'))
+
+    assert len(extracted) == 9
+    assert sum(len(images) for images in _image_anchors(output).values()) == 9
+
+
+
+@pytest.mark.parametrize('shard_sheets', [False, True], ids=['serial', 'sharded'])
+def test_in_place_drawing_repair_keeps_source_readable(tmp_path, shard_sheets):
+    path = tmp_path / 'book.xlsx'
+    path.write_bytes(_make_wps_workbook({'S0': 4, 'S1': 3}))
+
+    # 输出就是源文件：保存时仍需从源文件映射中读取图片
+    result = PreciseSafeWPSExcelFixer(str(path)).fix_excel_file_precise_safe(
+        str(path), shard_sheets=shard_sheets, max_workers=2)
+
+    assert result == str(path)
+    assert {sheet: len(images) for sheet, images in _image_anchors(path).items()} == {'S0': 4, 'S1': 3}
+    assert [item.name for item in tmp_path.iterdir()] == ['book.xlsx']
+
+
+# ========== 增量修复 ==========
+
+def test_incremental_repair_reuses_unchanged_sheets(tmp_path, capsys):
+    source = tmp_path / 'source.xlsx'
+    output = tmp_path / 'output.xlsx'
+    fingerprint = tmp_path / 'output.xlsx.fingerprint.json'
+
+    # 非增量修复不记录指纹
+    source.write_bytes(_make_wps_workbook({'S0': 4, 'S1': 4, 'S2': 4}))
+    assert PreciseSafeWPSExcelFixer(str(source)).fix_excel_file_precise_safe(str(output))
+    assert not fingerprint.exists()
+
+    assert PreciseSafeWPSExcelFixer(str(source)).fix_excel_file_precise_safe(str(output), incremental=True)
+    assert fingerprint.exists()
+    capsys.readouterr()
+
+    # 只改动最后一个工作表，前面工作表的XML保持不变
+    source.write_bytes(_make_wps_workbook({'S0': 4, 'S1': 4, 'S2': 5}))
+    assert PreciseSafeWPSExcelFixer(str(source)).fix_excel_file_precise_safe(str(output), incremental=True)
+    log = capsys.readouterr().out
+    assert '复用工作表: S0' in log
+    assert '复用工作表: S1' in log
+    assert '复用工作表: S2' not in log
+
+    with zipfile.ZipFile(output) as package:
+        assert package.testzip() is None
+    workbook = openpyxl.load_workbook(output)
+    assert {sheet.title: len(sheet._images) for sheet in workbook} == {'S0': 4, 'S1': 4, 'S2': 5}
+    assert not any('DISPIMG' in str(cell.value) for sheet in workbook for row in sheet.iter_rows() for cell in row)
+
+
+def test_non_incremental_overwrite_removes_stale_fingerprint(tmp_path):
+    source = tmp_path / 'source.xlsx'
+    output = tmp_path / 'output.xlsx'
+    source.write_bytes(_make_wps_workbook({'S0': 2}))
+
+    assert PreciseSafeWPSExcelFixer(str(source)).fix_excel_file_precise_safe(str(output), incremental=True)
+    assert (tmp_path / 'output.xlsx.fingerprint.json').exists()
+
+    assert PreciseSafeWPSExcelFixer(str(source)).fix_excel_file_precise_safe(str(output))
+    assert not (tmp_path / 'output.xlsx.fingerprint.json').exists()
+    assert [path.name for path in tmp_path.iterdir() if path.suffix == '.tmp'] == []
+
+
+def test_incremental_reuse_shares_one_buffer_per_distinct_image(tmp_path):
+    source = tmp_path / 'source.xlsx'
+    output = tmp_path / 'output.xlsx'
+    source.write_bytes(_make_wps_workbook({'S0': 8, 'S1': 8}, image_count=2))
+    # 首次完整修复由openpyxl为每个单元格写一份图片
+    assert PreciseSafeWPSExcelFixer(str(source)).fix_excel_file_precise_safe(str(output), incremental=True)
+
+    fixer = PreciseSafeWPSExcelFixer(str(source))
+    try:
+        cell_table = fixer.analyze_dispimg_cells()
+        fingerprints = fixer._sheet_fingerprints(cell_table, fixer.get_image_mapping())
+        reused = fixer._load_reusable_drawings(str(output), fingerprints)
+    finally:
+        fixer.close()
+
+    assert set(reused) == {'S0', 'S1'}
+    buffers = {id(data) for _, media, _ in reused.values() for _, _, data in media}
+    assert len(buffers) == 2
+
+    assert PreciseSafeWPSExcelFixer(str(source)).fix_excel_file_precise_safe(str(output), incremental=True)
+    with zipfile.ZipFile(output) as package:
+        assert len([name for name in package.namelist() if name.startswith('xl/media/')]) == 2
+    assert {sheet: len(images) for sheet, images in _image_anchors(output).items()} == {'S0': 8, 'S1': 8}
+
+
+# ========== richData单元格内图片 ==========
+
+RICHDATA_NS = {
+    'main': 'http://schemas.openxmlformats.org/spreadsheetml/2006/main',
+    'xlrd': 'http://schemas.microsoft.com/office/spreadsheetml/2017/richdata',
+    'rvrel': 'http://schemas.microsoft.com/office/spreadsheetml/2022/richvaluerel',
+    'rel': 'http://schemas.openxmlformats.org/package/2006/relationships',
+    'ct': 'http://schemas.openxmlformats.org/package/2006/content-types',
+}
+R_ID = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}id'
+
+
+def _rich_value_media(package):
+    """按vm编号（1起）解析出每个单元格值最终引用的图片部件名"""
+    metadata = ET.fromstring(package.read('xl/metadata.xml'))
+    future_blocks = [bk.find('.//xlrd:rvb', RICHDATA_NS).attrib['i'] for bk in
+                     metadata.findall('main:futureMetadata/main:bk', RICHDATA_NS)]
+    value_blocks = [bk.find('main:rc', RICHDATA_NS).attrib['v'] for bk in
+                    metadata.findall('main:valueMetadata/main:bk', RICHDATA_NS)]
+    rich_values = [rv.find('xlrd:v', RICHDATA_NS).text for rv in
+                   ET.fromstring(package.read('xl/richData/rdrichvalue.xml')).findall('xlrd:rv', RICHDATA_NS)]
+    rel_ids = [rel.attrib[R_ID] for rel in
+               ET.fromstring(package.read('xl/richData/richValueRel.xml')).findall('rvrel:rel', RICHDATA_NS)]
+    targets = {rel.attrib['Id']: posixpath.normpath(posixpath.join('xl/richData', rel.attrib['Target']))
+               for rel in ET.fromstring(package.read('xl/richData/_rels/richValueRel.xml.rels'))}
+    return {
+        vm: targets[rel_ids[int(rich_values[int(future_blocks[int(value_block)])])]]
+        for vm, value_block in enumerate(value_blocks, 1)
+    }
+
+
+def test_richdata_package_shares_one_value_per_image(tmp_path):
+    source = tmp_path / 'source.xlsx'
+    source.write_bytes(_make_wps_workbook({'S0': 4, 'S1': 3}))
+    output = PreciseSafeWPSExcelFixer(str(source)).fix_excel_file_precise_safe(
+        str(tmp_path / 'richdata.xlsx'), output_mode='richdata')
+
+    with zipfile.ZipFile(source) as original, zipfile.ZipFile(output) as package:
+        assert package.testzip() is None
+        # 单元格写为#VALUE!错误值并带vm属性
+        cell_vms = {}
+        for sheet_name, part in (('S0', 'xl/worksheets/sheet1.xml'), ('S1', 'xl/worksheets/sheet2.xml')):
+            sheet_xml = package.read(part).decode('utf-8')
+            for coordinate, attributes in re.findall(r'<c r="(B\d+)"([^>]*)>', sheet_xml):
+                assert 't="e"' in attributes
+                cell_vms[sheet_name, coordinate] = int(re.search(r'vm="(\d+)"', attributes).group(1))
+        assert len(cell_vms) == 7
+
+        # 行号对3取余决定图片：同一图片的单元格共用同一个vm，三张图片各一条值记录
+        assert cell_vms['S0', 'B1'] == cell_vms['S0', 'B4'] == cell_vms['S1', 'B1']
+        assert len(set(cell_vms.values())) == 3
+        vm_media = _rich_value_media(package)
+        assert sorted(vm_media) == [1, 2, 3]
+        assert package.read(vm_media[cell_vms['S0', 'B2']]) == original.read('xl/media/image3.png')
+        assert package.read(vm_media[cell_vms['S0', 'B3']]) == original.read('xl/media/image1.png')
+
+        # 每张不同的图片只有一个媒体部件
+        media = sorted(name for name in package.namelist() if name.startswith('xl/media/'))
+        assert media == sorted(vm_media.values())
+
+        content_types = ET.fromstring(package.read('[Content_Types].xml'))
+        overrides = {item.attrib['PartName']: item.attrib['ContentType']
+                     for item in content_types.findall('ct:Override', RICHDATA_NS)}
+        defaults = {item.attrib['Extension'] for item in content_types.findall('ct:Default', RICHDATA_NS)}
+        assert overrides['/xl/metadata.xml'].endswith('sheetMetadata+xml')
+        for part in ('rdrichvalue', 'rdrichvaluestructure', 'rdRichValueTypes', 'richValueRel'):
+            assert f'/xl/richData/{part}.xml' in overrides
+        assert 'png' in defaults
+
+        workbook_rels = {rel.attrib['Target'] for rel in
+                         ET.fromstring(package.read('xl/_rels/workbook.xml.rels')).findall('rel:Relationship', RICHDATA_NS)}
+        assert {'metadata.xml', 'richData/richValueRel.xml', 'richData/rdrichvalue.xml',
+                'richData/rdrichvaluestructure.xml', 'richData/rdRichValueTypes.xml'} <= workbook_rels
+
+
+def test_in_place_richdata_repair_keeps_all_images(tmp_path):
+    path = tmp_path / 'book.xlsx'
+    path.write_bytes(_make_wps_workbook({'S0': 4, 'S1': 3}))
+
+    result = PreciseSafeWPSExcelFixer(str(path)).fix_excel_file_precise_safe(str(path), output_mode='richdata')
+
+    assert result == str(path)
+    with zipfile.ZipFile(path) as package:
+        assert package.testzip() is None
+        assert len(_rich_value_media(package)) == 3
+        assert len([name for name in package.namelist() if name.startswith('xl/media/')]) == 3
+    assert [item.name for item in tmp_path.iterdir()] == ['book.xlsx']
@@ -11,78 +11,672 @@ import os
 import xml.etree.ElementTree as ET
 import openpyxl
 from openpyxl.drawing.image import Image as OpenpyxlImage
-from openpyxl.drawing.spreadsheet_drawing import OneCellAnchor, AnchorMarker
+from openpyxl.drawing.spreadsheet_drawing import OneCellAnchor, AnchorMarker, SpreadsheetDrawing
+from openpyxl.packaging.manifest import Override, mimetypes as openpyxl_mimetypes
+from openpyxl.packaging.relationship import Relationship, RelationshipList, get_rels_path
 from openpyxl.utils import get_column_letter
 from openpyxl.utils.units import pixels_to_EMU
+from openpyxl.worksheet._writer import WorksheetWriter
+from openpyxl.worksheet.related import Related
+from openpyxl.writer.excel import ExcelWriter
+from openpyxl.xml.constants import SHEET_DRAWING_NS
+from openpyxl.xml.functions import tostring
+import datetime
+import hashlib
 import io
+import json
+import mmap
+import posixpath
+import re
+import struct
+import zlib
+from array import array
+from itertools import groupby
+from concurrent.futures import ProcessPoolExecutor
 from PIL import Image as PILImage
 
 
+class _MappedFileView(io.RawIOBase):
+    """内存映射之上的只读文件接口，供zipfile/openpyxl按需读取，不复制整个文件"""
+
+    def __init__(self, view):
+        super().__init__()
+        self._view = view
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = len(self._view) + offset
+        else:
+            raise ValueError(f"无效的whence参数: {whence}")
+        if pos < 0:
+            # 与真实文件一致抛出OSError，zipfile据此判断文件过短而不是出错
+            raise OSError(f"无效的偏移位置: {pos}")
+        self._pos = pos
+        return self._pos
+
+    def readinto(self, buffer):
+        data = self._view[self._pos:self._pos + len(buffer)]
+        size = len(data)
+        buffer[:size] = data
+        self._pos += size
+        return size
+
+
+class MappedXlsxReader:
+    """基于内存映射的xlsx读取器：未压缩条目返回零拷贝memoryview，压缩条目增量解压
+    
+    source可以是文件路径、bytes类对象或文件对象：路径和真实文件通过mmap映射，
+    bytes与BytesIO直接引用其缓冲区，其他文件对象读入内存后使用。
+    """
+
+    # 本地文件头固定部分长度，文件名长度和扩展字段长度位于第26字节起
+    LOCAL_HEADER_SIZE = 30
+    INFLATE_CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, source):
+        self.source = source
+        self._file = None   # 仅在由本对象打开文件时设置
+        self._mmap = None
+        self._zfile = None
+        
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            self._view = memoryview(source).cast('B')
+        elif isinstance(source, io.BytesIO):
+            self._view = source.getbuffer()
+        elif hasattr(source, 'read'):
+            self._view = self._map_file_object(source)
+        else:
+            self._file = open(source, 'rb')
+            try:
+                self._view = self._map_file(self._file)
+            except (OSError, ValueError):
+                self._file.close()
+                raise
+        try:
+            self._zfile = zipfile.ZipFile(self.open_file(), 'r')
+        except Exception:
+            # 非zip或已损坏的文件：释放已打开的文件和映射，避免文件被锁定
+            self.close()
+            raise
+        self._entries = {info.filename: info for info in self._zfile.infolist()}
+
+    def _map_file(self, file):
+        self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(self._mmap)
+    
+    def _map_file_object(self, file):
+        """优先映射文件对象背后的真实文件，无法映射时（管道、网络流等）读入内存"""
+        try:
+            return self._map_file(file)
+        except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+            if file.seekable():
+                file.seek(0)
+            return memoryview(file.read())
+    
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __contains__(self, name):
+        return name in self._entries
+
+    def namelist(self):
+        return list(self._entries)
+
+    def getinfo(self, name):
+        return self._entries[name]
+
+    def open_file(self):
+        """返回一个独立读写位置的文件对象，可直接交给openpyxl或zipfile"""
+        return _MappedFileView(self._view)
+
+    def _data_span(self, info):
+        """根据本地文件头定位条目数据在映射中的起止位置"""
+        offset = info.header_offset
+        if self._view[offset:offset + 4] != b'PK\x03\x04':
+            raise zipfile.BadZipFile(f"本地文件头损坏: {info.filename}")
+        name_len, extra_len = struct.unpack_from('<HH', self._view, offset + 26)
+        start = offset + self.LOCAL_HEADER_SIZE + name_len + extra_len
+        return start, start + info.compress_size
+
+    def _is_direct(self, info):
+        """未加密且为存储/deflate压缩的条目可直接从映射读取"""
+        return (not info.flag_bits & 0x1 and
+                info.compress_type in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED))
+
+    def iter_chunks(self, name, chunk_size=INFLATE_CHUNK_SIZE):
+        """按块读取条目内容：存储条目逐块返回memoryview，压缩条目逐块解压"""
+        info = self._entries[name]
+        if not self._is_direct(info):
+            yield self._zfile.read(name)
+            return
+
+        start, end = self._data_span(info)
+        crc = 0
+        if info.compress_type == zipfile.ZIP_STORED:
+            for pos in range(start, end, chunk_size):
+                chunk = self._view[pos:min(pos + chunk_size, end)]
+                crc = zlib.crc32(chunk, crc)
+                yield chunk
+        else:
+            inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+            for pos in range(start, end, chunk_size):
+                chunk = inflater.decompress(self._view[pos:min(pos + chunk_size, end)])
+                if chunk:
+                    crc = zlib.crc32(chunk, crc)
+                    yield chunk
+            chunk = inflater.flush()
+            if chunk:
+                crc = zlib.crc32(chunk, crc)
+                yield chunk
+
+        if crc != info.CRC:
+            raise zipfile.BadZipFile(f"CRC校验失败: {name}")
+
+    def read(self, name):
+        """读取条目内容，存储条目返回零拷贝memoryview，其余返回bytes"""
+        info = self._entries[name]
+        if self._is_direct(info) and info.compress_type == zipfile.ZIP_STORED:
+            start, end = self._data_span(info)
+            data = self._view[start:end]
+            if zlib.crc32(data) != info.CRC:
+                raise zipfile.BadZipFile(f"CRC校验失败: {name}")
+            return data
+        return b''.join(self.iter_chunks(name))
+
+    def close(self):
+        """释放映射，仍被外部引用的memoryview会在回收时自动释放映射"""
+        if self._view is None:
+            return
+        if self._zfile is not None:
+            self._zfile.close()
+        self._view.release()
+        self._view = None
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                pass
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+DRAWING_REL_TYPE = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships/drawing'
+IMAGE_REL_TYPE = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships/image'
+DRAWING_CONTENT_TYPE = 'application/vnd.openxmlformats-officedocument.drawing+xml'
+
+
+class _AttachedDrawingWorksheetWriter(WorksheetWriter):
+    """在<drawing>位置引用预先生成好的绘图部件，而不是由openpyxl根据图片对象生成"""
+    
+    def __init__(self, ws, out, drawing_path):
+        super().__init__(ws, out)
+        self._drawing_path = drawing_path
+    
+    def write_drawings(self):
+        rel = Relationship(type="drawing", Target=self._drawing_path)
+        self._rels.append(rel)
+        drawing = Related()
+        drawing.id = rel.id
+        self.xf.send(drawing.to_tree("drawing"))
+
+
+class _PatchedZipFile(zipfile.ZipFile):
+    """写入指定部件时先经过修改函数，用于在openpyxl的单次保存中补充它不生成的内容"""
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.patches = {}   # {部件名: 接收并返回部件数据的函数}
+    
+    def writestr(self, zinfo_or_arcname, data, *args, **kwargs):
+        name = getattr(zinfo_or_arcname, 'filename', zinfo_or_arcname)
+        patch = self.patches.get(name)
+        if patch is not None:
+            data = patch(data)
+        super().writestr(zinfo_or_arcname, data, *args, **kwargs)
+
+
+class _InMemoryExcelWriter(ExcelWriter):
+    """openpyxl的ExcelWriter，工作表直接序列化到内存，不创建临时文件
+    
+    attached_drawings为{工作表名: (绘图XML, [(关系ID, 图片部件名, 图片数据)], 锚定单元格)}，
+    这些预先生成的绘图（分片子进程的结果或增量复用的上次结果）随工作表一起写入。
+    rich_cells为{工作表名: {坐标: vm序号}}，rich_images为按vm顺序排列的源图片部件名，
+    给出时单元格的vm属性和richData部件在同一次保存中写入。
+    图片数据为None或来自rich_images时从reader逐块读取源文件中的同名部件；同一图片只写入一份。
+    archive需为_PatchedZipFile。
+    """
+    
+    def __init__(self, workbook, archive, attached_drawings=None, reader=None,
+                 rich_cells=None, rich_images=None):
+        super().__init__(workbook, archive)
+        self._attached_drawings = attached_drawings or {}
+        self._reader = reader
+        self._rich_cells = rich_cells or {}
+        self._rich_images = rich_images or []
+        self._attached_count = 0
+        self._media = {}
+        if self._rich_images:
+            archive.patches['xl/_rels/workbook.xml.rels'] = (
+                lambda data: _add_relationships(data, RICHDATA_WORKBOOK_RELS))
+    
+    def write_worksheet(self, ws):
+        ws._drawing = SpreadsheetDrawing()
+        ws._drawing.charts = ws._charts
+        ws._drawing.images = ws._images
+        attached = self._attached_drawings.get(ws.title)
+        # 没有成功锚定任何图片的分片不生成空绘图
+        if attached is not None and attached[1] and not ws._drawing:
+            drawing_xml, media, _ = attached
+            drawing_path = self._write_attached_drawing(drawing_xml, media)
+            writer = _AttachedDrawingWorksheetWriter(ws, io.BytesIO(), drawing_path)
+        else:
+            writer = WorksheetWriter(ws, out=io.BytesIO())
+        writer.write()
+        ws._rels = writer._rels
+        sheet_xml = writer.read()
+        if ws.title in self._rich_cells:
+            sheet_xml = _mark_rich_value_cells(sheet_xml, self._rich_cells[ws.title])
+        self._archive.writestr(ws.path[1:], sheet_xml)
+        self.manifest.append(ws)
+    
+    def _write_images(self):
+        super()._write_images()
+        if self._rich_images:
+            self._write_rich_data()
+    
+    def _write_media(self, media_name, data=None):
+        """写入一张图片并返回其部件路径，同一来源的图片只写入一份"""
+        key = (media_name, data is None)
+        target = self._media.get(key)
+        if target is None:
+            # 使用独立的部件名前缀，不与openpyxl自己编号的图片冲突
+            extension = posixpath.splitext(media_name)[1].lower() or '.png'
+            target = f'/xl/media/wpsImage{len(self._media) + 1}{extension}'
+            self._media[key] = target
+            if data is None:
+                with self._archive.open(target[1:], 'w') as media_file:
+                    for chunk in self._reader.iter_chunks(media_name):
+                        media_file.write(chunk)
+            else:
+                self._archive.writestr(target[1:], data)
+        return target
+    
+    def _write_attached_drawing(self, drawing_xml, media):
+        """写入预先生成的绘图部件及其图片，返回绘图部件路径"""
+        self._attached_count += 1
+        drawing_path = f'/xl/drawings/wpsDrawing{self._attached_count}.xml'
+        rels = RelationshipList()
+        for rel_id, media_name, data in media:
+            target = self._write_media(media_name, data)
+            rels.append(Relationship(Id=rel_id, Type=IMAGE_REL_TYPE, Target=target))
+        self._archive.writestr(drawing_path[1:], drawing_xml)
+        self._archive.writestr(get_rels_path(drawing_path)[1:], tostring(rels.to_tree()))
+        self.manifest.Override.append(Override(PartName=drawing_path, ContentType=DRAWING_CONTENT_TYPE))
+        return drawing_path
+    
+    def _write_rich_data(self):
+        """写入单元格内图片引用的媒体文件和richData部件，图片直接从源文件映射逐块写入"""
+        media_names = [self._write_media(f'xl/{image_path}')[1:] for image_path in self._rich_images]
+        for part_name, xml in _richdata_parts(media_names):
+            self._archive.writestr(part_name, XML_DECLARATION + xml)
+        for part_name, content_type in RICHDATA_CONTENT_TYPES:
+            self.manifest.Override.append(Override(PartName=part_name, ContentType=content_type))
+
+
+def _save_workbook(workbook, output, attached_drawings=None, reader=None, rich_cells=None, rich_images=None):
+    """等同workbook.save(output)，但整个保存过程不落盘临时文件，
+    并可附带预先生成的绘图或单元格内图片（参数含义见_InMemoryExcelWriter）"""
+    archive = _PatchedZipFile(output, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+    workbook.properties.modified = datetime.datetime.now(tz=datetime.timezone.utc).replace(tzinfo=None)
+    _InMemoryExcelWriter(workbook, archive, attached_drawings, reader, rich_cells, rich_images).save()
+
+
+class DispimgCellTable:
+    """DISPIMG单元格扫描结果的紧凑列式存储
+    
+    每条记录只占四个数组元素：工作表索引、行号、列号、图片ID索引，
+    工作表名和图片ID各自去重后只保存一份。
+    """
+    
+    def __init__(self):
+        self.sheet_names = []
+        self.image_ids = []
+        self._image_id_index = {}
+        self.sheet_indexes = array('I')
+        self.rows = array('I')
+        self.columns = array('H')   # Excel最多16384列
+        self.image_indexes = array('I')
+    
+    def __len__(self):
+        return len(self.rows)
+    
+    def add_sheet(self, sheet_name):
+        """登记工作表并返回其索引，之后该表的记录需连续追加"""
+        self.sheet_names.append(sheet_name)
+        return len(self.sheet_names) - 1
+    
+    def append(self, sheet_index, row, column, image_id):
+        """追加一条记录，图片ID在表内去重"""
+        image_index = self._image_id_index.get(image_id)
+        if image_index is None:
+            image_index = self._image_id_index[image_id] = len(self.image_ids)
+            self.image_ids.append(image_id)
+        self.sheet_indexes.append(sheet_index)
+        self.rows.append(row)
+        self.columns.append(column)
+        self.image_indexes.append(image_index)
+    
+    def truncate(self, length):
+        """丢弃length之后的记录（用于回滚分析失败的工作表）"""
+        for column in (self.sheet_indexes, self.rows, self.columns, self.image_indexes):
+            del column[length:]
+    
+    def sheets(self):
+        """按工作表返回(工作表名, 起始位置, 结束位置)，只包含有记录的工作表"""
+        spans = []
+        start = 0
+        for sheet_index, group in groupby(self.sheet_indexes):
+            stop = start + sum(1 for _ in group)
+            spans.append((self.sheet_names[sheet_index], start, stop))
+            start = stop
+        return spans
+    
+    def records(self, start=0, stop=None):
+        """逐条产出(行号, 列号, 图片ID)，不创建中间列表"""
+        if stop is None:
+            stop = len(self)
+        image_ids = self.image_ids
+        for i in range(start, stop):
+            yield self.rows[i], self.columns[i], image_ids[self.image_indexes[i]]
+
+
+# ========== richData 单元格内图片 ==========
+# Excel原生"放置在单元格中"的图片：单元格通过vm属性引用valueMetadata，
+# 再经rdrichvalue和richValueRel指向共享的媒体文件，不需要任何绘图对象。
+
+RICHDATA_CONTENT_TYPES = [
+    ('/xl/metadata.xml', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheetMetadata+xml'),
+    ('/xl/richData/rdRichValueTypes.xml', 'application/vnd.ms-excel.rdrichvaluetypes+xml'),
+    ('/xl/richData/rdrichvalue.xml', 'application/vnd.ms-excel.rdrichvalue+xml'),
+    ('/xl/richData/rdrichvaluestructure.xml', 'application/vnd.ms-excel.rdrichvaluestructure+xml'),
+    ('/xl/richData/richValueRel.xml', 'application/vnd.ms-excel.richvaluerel+xml'),
+]
+
+RICHDATA_WORKBOOK_RELS = [
+    ('http://schemas.openxmlformats.org/officeDocument/2006/relationships/sheetMetadata', 'metadata.xml'),
+    ('http://schemas.microsoft.com/office/2022/10/relationships/richValueRel', 'richData/richValueRel.xml'),
+    ('http://schemas.microsoft.com/office/2017/06/relationships/rdRichValue', 'richData/rdrichvalue.xml'),
+    ('http://schemas.microsoft.com/office/2017/06/relationships/rdRichValueStructure', 'richData/rdrichvaluestructure.xml'),
+    ('http://schemas.microsoft.com/office/2017/06/relationships/rdRichValueTypes', 'richData/rdRichValueTypes.xml'),
+]
+
+IMAGE_CONTENT_TYPES = {
+    'png': 'image/png',
+    'jpg': 'image/jpeg',
+    'jpeg': 'image/jpeg',
+    'gif': 'image/gif',
+    'bmp': 'image/bmp',
+    'tif': 'image/tiff',
+    'tiff': 'image/tiff',
+    'webp': 'image/webp',
+}
+
+# openpyxl按扩展名登记[Content_Types].xml中的默认类型，补上它不认识的图片扩展名
+for _extension, _content_type in IMAGE_CONTENT_TYPES.items():
+    openpyxl_mimetypes.add_type(_content_type, f'.{_extension}')
+
+XML_DECLARATION = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+
+_CELL_TAG_RE = re.compile(rb'<c r="([A-Z]+[0-9]+)"([^>]*?)(/?)>')
+
+
+def _resolve_target(source_part, target):
+    """把关系中的Target（绝对或相对路径）解析为包内部件名"""
+    if target.startswith('/'):
+        return target.lstrip('/')
+    return posixpath.normpath(posixpath.join(posixpath.dirname(source_part), target))
+
+
+def _rels_part_name(part_name):
+    """部件对应的关系部件名，如xl/worksheets/sheet1.xml -> xl/worksheets/_rels/sheet1.xml.rels"""
+    directory, filename = posixpath.split(part_name)
+    return posixpath.join(directory, '_rels', filename + '.rels')
+
+
+def _sheet_part_paths(archive):
+    """解析workbook.xml及其关系，返回工作表名到工作表XML路径的映射
+    
+    archive只需提供read(name)，zipfile.ZipFile和MappedXlsxReader均可。
+    """
+    namespaces = {
+        'main': 'http://schemas.openxmlformats.org/spreadsheetml/2006/main',
+        'rel': 'http://schemas.openxmlformats.org/package/2006/relationships',
+    }
+    r_id = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}id'
+    
+    rels_root = ET.fromstring(archive.read('xl/_rels/workbook.xml.rels'))
+    targets = {
+        rel.attrib['Id']: _resolve_target('xl/workbook.xml', rel.attrib['Target'])
+        for rel in rels_root.findall('rel:Relationship', namespaces)
+    }
+    
+    workbook_root = ET.fromstring(archive.read('xl/workbook.xml'))
+    return {
+        sheet.attrib['name']: targets[sheet.attrib[r_id]]
+        for sheet in workbook_root.findall('main:sheets/main:sheet', namespaces)
+        if sheet.attrib.get(r_id) in targets
+    }
+
+
+def _mark_rich_value_cells(sheet_xml, cell_vms):
+    """给指定坐标的单元格加上vm属性，使其引用对应的图片值元数据"""
+    def replace(match):
+        vm = cell_vms.get(match.group(1).decode('ascii'))
+        if vm is None:
+            return match.group(0)
+        return b'<c r="%s"%s vm="%d"%s>' % (match.group(1), match.group(2), vm, match.group(3))
+    return _CELL_TAG_RE.sub(replace, sheet_xml)
+
+
+def _add_relationships(rels_xml, relationships):
+    """在关系部件中追加关系，关系ID接在现有最大编号之后"""
+    text = rels_xml.decode('utf-8')
+    next_id = max((int(n) for n in re.findall(r'Id="rId(\d+)"', text)), default=0) + 1
+    additions = ''.join(
+        f'<Relationship Id="rId{next_id + offset}" Type="{rel_type}" Target="{target}"/>'
+        for offset, (rel_type, target) in enumerate(relationships))
+    return text.replace('</Relationships>', additions + '</Relationships>').encode('utf-8')
+
+
+def _richdata_parts(media_names):
+    """生成richData相关部件，每个媒体文件对应一条共享的图片值记录"""
+    count = len(media_names)
+    future_blocks = ''.join(
+        f'<bk><extLst><ext uri="{{3e2802c4-a4d2-4d8b-9148-e3be6c30e623}}"><xlrd:rvb i="{i}"/></ext></extLst></bk>'
+        for i in range(count))
+    value_blocks = ''.join(f'<bk><rc t="1" v="{i}"/></bk>' for i in range(count))
+    metadata = (
+        '<metadata xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:xlrd="http://schemas.microsoft.com/office/spreadsheetml/2017/richdata">'
+        '<metadataTypes count="1"><metadataType name="XLRICHVALUE" minSupportedVersion="120000" '
+        'copy="1" pasteAll="1" pasteValues="1" merge="1" splitFirst="1" rowColShift="1" '
+        'clearFormats="1" clearComments="1" assign="1" coerce="1"/></metadataTypes>'
+        f'<futureMetadata name="XLRICHVALUE" count="{count}">{future_blocks}</futureMetadata>'
+        f'<valueMetadata count="{count}">{value_blocks}</valueMetadata></metadata>')
+    
+    # 第一个值是richValueRel中的图片序号，第二个值CalcOrigin=5表示本地图片
+    rich_values = ''.join(f'<rv s="0"><v>{i}</v><v>5</v></rv>' for i in range(count))
+    rdrichvalue = (
+        '<rvData xmlns="http://schemas.microsoft.com/office/spreadsheetml/2017/richdata" '
+        f'count="{count}">{rich_values}</rvData>')
+    
+    rdrichvaluestructure = (
+        '<rvStructures xmlns="http://schemas.microsoft.com/office/spreadsheetml/2017/richdata" count="1">'
+        '<s t="_localImage"><k n="_rvRel:LocalImageIdentifier" t="i"/><k n="CalcOrigin" t="i"/></s>'
+        '</rvStructures>')
+    
+    key_flags = ''.join(
+        f'<key name="{key}"><flag name="ExcludeFromCalcComparison" value="1"/></key>'
+        for key in ('_DisplayString', '_Flags', '_Format', '_SubLabel', '_Attribution',
+                    '_Icon', '_Display', '_CanonicalPropertyNames', '_ClassificationId'))
+    rd_rich_value_types = (
+        '<rvTypesInfo xmlns="http://schemas.microsoft.com/office/spreadsheetml/2017/richdata2" '
+        'xmlns:mc="http://schemas.openxmlformats.org/markup-compatibility/2006" mc:Ignorable="x" '
+        'xmlns:x="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><global><keyFlags>'
+        '<key name="_Self"><flag name="ExcludeFromFile" value="1"/>'
+        '<flag name="ExcludeFromCalcComparison" value="1"/></key>'
+        f'{key_flags}</keyFlags></global></rvTypesInfo>')
+    
+    rels = ''.join(f'<rel r:id="rId{i + 1}"/>' for i in range(count))
+    rich_value_rel = (
+        '<richValueRels xmlns="http://schemas.microsoft.com/office/spreadsheetml/2022/richvaluerel" '
+        f'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">{rels}</richValueRels>')
+    
+    image_rels = ''.join(
+        f'<Relationship Id="rId{i + 1}" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/image" '
+        f'Target="../media/{posixpath.basename(name)}"/>'
+        for i, name in enumerate(media_names))
+    rich_value_rel_rels = (
+        f'<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">{image_rels}</Relationships>')
+    
+    return [
+        ('xl/metadata.xml', metadata),
+        ('xl/richData/rdrichvalue.xml', rdrichvalue),
+        ('xl/richData/rdrichvaluestructure.xml', rdrichvaluestructure),
+        ('xl/richData/rdRichValueTypes.xml', rd_rich_value_types),
+        ('xl/richData/richValueRel.xml', rich_value_rel),
+        ('xl/richData/_rels/richValueRel.xml.rels', rich_value_rel_rels),
+    ]
+
+
+# ========== 增量修复 ==========
+# 每次输出时在旁边记录各工作表的指纹（工作表XML哈希 + 它用到的映射条目），
+# 源文件再次提交时，指纹未变的工作表直接复用上次输出中的绘图部件和图片。
+
+FINGERPRINT_VERSION = 1
+FINGERPRINT_SUFFIX = '.fingerprint.json'
+
+
+def _read_relationships(archive, part_name):
+    """读取部件的关系，返回[(关系ID, 关系类型, 目标部件名)]，没有关系部件时返回空列表"""
+    rels_name = _rels_part_name(part_name)
+    if rels_name not in archive:
+        return []
+    namespaces = {'rel': 'http://schemas.openxmlformats.org/package/2006/relationships'}
+    root = ET.fromstring(archive.read(rels_name))
+    return [
+        (rel.attrib['Id'], rel.attrib['Type'], _resolve_target(part_name, rel.attrib['Target']))
+        for rel in root.findall('rel:Relationship', namespaces)
+        if rel.attrib.get('TargetMode') != 'External'
+    ]
+
+
 class PreciseSafeWPSExcelFixer:
     """精确且安全的WPS Excel修复工具，结合perfect.py的精确计算和safe.py的安全特性"""
     
-    def __init__(self, xlsx_file_path):
-        self.xlsx_file_path = xlsx_file_path
-        self.image_list = []
+    # 输出模式：浮动图片（OneCellAnchor绘图对象）或Excel单元格内图片（richData）
+    OUTPUT_MODE_DRAWING = 'drawing'
+    OUTPUT_MODE_RICHDATA = 'richdata'
+    OUTPUT_MODES = (OUTPUT_MODE_DRAWING, OUTPUT_MODE_RICHDATA)
+    
+    def __init__(self, source):
+        """source可以是xlsx文件路径，也可以是bytes或可读文件对象（无需落盘）"""
+        self.source = source
+        self.xlsx_file_path = source if isinstance(source, (str, os.PathLike)) else None
         self.workbook = None
+        self.dispimg_cell_count = None   # 最近一次分析发现的DISPIMG公式数量，无法加载时为None
+        self._reader = None
+        
+    @staticmethod
+    def default_output_path(xlsx_file_path):
+        """默认输出路径：在原文件名后追加_fixed，只改动文件名末尾的扩展名"""
+        root, extension = os.path.splitext(os.fspath(xlsx_file_path))
+        return f"{root}_fixed{extension or '.xlsx'}"
+        
+    def _is_source_file(self, output_path):
+        """输出路径是否就是源文件本身（原地修复）"""
+        return (self.xlsx_file_path is not None and os.path.exists(output_path) and
+                os.path.samefile(self.xlsx_file_path, output_path))
+        
+    def _get_reader(self):
+        """获取（必要时打开）源文件的内存映射读取器"""
+        if self._reader is None:
+            self._reader = MappedXlsxReader(self.source)
+        return self._reader
+    
+    def close(self):
+        """释放源文件的内存映射"""
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
         
     def analyze_dispimg_cells(self):
         """分析所有工作表中包含DISPIMG公式的单元格"""
         try:
-            self.workbook = openpyxl.load_workbook(self.xlsx_file_path, data_only=False)
+            self.workbook = openpyxl.load_workbook(self._get_reader().open_file(), data_only=False)
         except Exception as e:
             print(f"无法加载Excel文件: {e}")
-            return {}
+            return DispimgCellTable()
             
-        all_dispimg_cells = {}
+        cell_table = DispimgCellTable()
         
         for sheet_name in self.workbook.sheetnames:
             sheet = self.workbook[sheet_name]
-            dispimg_cells = []
+            sheet_index = cell_table.add_sheet(sheet_name)
+            sheet_start = len(cell_table)
             
             try:
-                for row in sheet.iter_rows(min_row=1, values_only=False):
-                    for cell in row:
-                        if (cell.value and isinstance(cell.value, str) and 
-                            '=_xlfn.DISPIMG(' in cell.value):
-                            formula = cell.value
-                            start = formula.find('"') + 1
-                            end = formula.find('"', start)
-                            image_id = formula[start:end]
-                            
-                            cell_info = {
-                                'cell': cell,
-                                'sheet': sheet,
-                                'sheet_name': sheet_name,
-                                'row': cell.row,
-                                'column': cell.column,
-                                'image_id': image_id,
-                                'coordinate': cell.coordinate
-                            }
-                            dispimg_cells.append(cell_info)
-                            self.image_list.append(image_id)
+                for row_number, row in enumerate(sheet.iter_rows(min_row=1, values_only=True), 1):
+                    for column_number, value in enumerate(row, 1):
+                        if (value and isinstance(value, str) and 
+                            '=_xlfn.DISPIMG(' in value):
+                            start = value.find('"') + 1
+                            end = value.find('"', start)
+                            cell_table.append(sheet_index, row_number, column_number, value[start:end])
             except Exception as e:
                 print(f"分析工作表 {sheet_name} 时出错: {e}")
+                cell_table.truncate(sheet_start)
                 continue
                 
-            if dispimg_cells:
-                all_dispimg_cells[sheet_name] = dispimg_cells
-                print(f"  发现 {len(dispimg_cells)} 个DISPIMG公式")
+            found = len(cell_table) - sheet_start
+            if found:
+                print(f"  发现 {found} 个DISPIMG公式")
                     
-        return all_dispimg_cells
+        self.dispimg_cell_count = len(cell_table)
+        return cell_table
     
     def get_image_mapping(self):
         """获取图片ID到文件路径的映射关系"""
         try:
-            with zipfile.ZipFile(self.xlsx_file_path, 'r') as zfile:
-                required_files = ['xl/cellimages.xml', 'xl/_rels/cellimages.xml.rels']
-                for req_file in required_files:
-                    if req_file not in zfile.namelist():
-                        print(f"缺少必要文件: {req_file}")
-                        return {}
-                        
-                xml_content = zfile.read('xl/cellimages.xml')
-                relxml_content = zfile.read('xl/_rels/cellimages.xml.rels')
+            reader = self._get_reader()
+            required_files = ['xl/cellimages.xml', 'xl/_rels/cellimages.xml.rels']
+            for req_file in required_files:
+                if req_file not in reader:
+                    print(f"缺少必要文件: {req_file}")
+                    return {}
+                    
+            xml_content = reader.read('xl/cellimages.xml')
+            relxml_content = reader.read('xl/_rels/cellimages.xml.rels')
         except Exception as e:
             print(f"读取图片映射时出错: {e}")
             return {}
@@ -127,25 +721,21 @@ class PreciseSafeWPSExcelFixer:
             return {}
     
     def extract_image_from_xlsx(self, image_path):
-        """从xlsx文件中提取指定路径的图片数据"""
+        """从xlsx文件中提取指定路径的图片数据（未压缩图片为零拷贝memoryview）"""
         try:
-            with zipfile.ZipFile(self.xlsx_file_path, 'r') as zfile:
-                actual_image_path = f'xl/{image_path}'
-                if actual_image_path in zfile.namelist():
-                    return zfile.read(actual_image_path)
+            reader = self._get_reader()
+            actual_image_path = f'xl/{image_path}'
+            if actual_image_path in reader:
+                return reader.read(actual_image_path)
         except Exception as e:
             print(f"提取图片数据时出错: {e}")
         return None
     
-    def get_precise_cell_dimensions(self, sheet, cell_info):
+    def get_precise_cell_dimensions(self, sheet, row, column):
         """精确计算单元格尺寸，优化缩放算法"""
         try:
-            row = cell_info['row']
-            column = cell_info['column']
-            coordinate = cell_info['coordinate']
-            sheet_name = cell_info['sheet_name']
-            
             column_letter = get_column_letter(column)
+            coordinate = f"{column_letter}{row}"
             
             # 安全获取列宽和行高
             try:
@@ -181,7 +771,7 @@ class PreciseSafeWPSExcelFixer:
             return cell_width_px, cell_height_px
             
         except Exception as e:
-            print(f"  获取单元格尺寸时出错 {cell_info['coordinate']}: {e}")
+            print(f"  获取单元格尺寸时出错 ({row}, {column}): {e}")
             return 150, 120  # 更大的安全默认值
     
     def calculate_proper_scaling(self, cell_width_px, cell_height_px, image_width, image_height):
@@ -220,14 +810,14 @@ class PreciseSafeWPSExcelFixer:
         
         return final_width, final_height
     
-    def create_safe_anchor(self, cell_info, final_width_px, final_height_px):
-        """创建精确的图片锚点，直接锚定到原始单元格"""
+    def create_safe_anchor(self, row, column, final_width_px, final_height_px):
+        """创建精确的图片锚点，直接锚定到原始单元格（row/column为1-based）"""
         try:
             from openpyxl.drawing.xdr import XDRPositiveSize2D
             
             # 使用原始单元格位置（0-based索引）
-            row = cell_info['row'] - 1
-            column = cell_info['column'] - 1
+            row = row - 1
+            column = column - 1
             
             # 转换为EMU单位
             final_width_emu = pixels_to_EMU(final_width_px)
@@ -246,20 +836,360 @@ class PreciseSafeWPSExcelFixer:
             print(f"    创建锚点时出错: {e}")
             return None
     
-    def fix_excel_file_precise_safe(self, output_path=None):
-        """精确且安全的修复Excel文件"""
+    def _iter_sheet_tasks(self, sheet, cell_table, start, stop):
+        """逐条产出工作表的图片任务(行, 列, 图片ID, 单元格宽, 单元格高)"""
+        for row, column, image_id in cell_table.records(start, stop):
+            cell_width_px, cell_height_px = self.get_precise_cell_dimensions(sheet, row, column)
+            yield row, column, image_id, cell_width_px, cell_height_px
+    
+    def _plan_sheet_images(self, tasks, image_mapping):
+        """逐条计算工作表中每张图片的最终尺寸，不修改工作簿，可在子进程中独立执行
+        
+        产出(行, 列, 图片ID, 图片路径, 宽, 高, 图片数据)，图片数据随方案传给下一阶段，不再重复解压。
+        """
+        for row, column, image_id, cell_width_px, cell_height_px in tasks:
+            if image_id not in image_mapping:
+                print(f"  [FAIL] 未找到图片映射: {image_id}")
+                continue
+                
+            image_path = image_mapping[image_id]
+            print(f"\n  正在处理图片: {image_id}")
+            
+            image_data = self.extract_image_from_xlsx(image_path)
+            if not image_data:
+                print(f"  [FAIL] 无法提取图片数据: {image_id}")
+                continue
+                
+            try:
+                # 获取图片原始尺寸
+                with PILImage.open(io.BytesIO(image_data)) as pil_img:
+                    original_width, original_height = pil_img.size
+                
+                # 计算精确缩放
+                final_width_px, final_height_px = self.calculate_proper_scaling(
+                    cell_width_px, cell_height_px, original_width, original_height)
+                
+                yield row, column, image_id, image_path, final_width_px, final_height_px, image_data
+            except Exception as e:
+                print(f"  [FAIL] 修复失败: {get_column_letter(column)}{row} - {str(e)}")
+    
+    def _render_sheet_drawing(self, plans):
+        """把图片方案直接序列化为绘图部件，结构与openpyxl生成的一致，可在子进程中独立执行
+        
+        返回(绘图XML, [(关系ID, 源文件中的图片部件名, None)], 锚定单元格{(行, 列)})，
+        图片本身不经过进程间传递，由保存时从源文件逐块写入。
+        """
+        drawing = SpreadsheetDrawing()
+        media = []
+        anchored_cells = set()
+        for row, column, _, image_path, final_width_px, final_height_px, _ in plans:
+            coordinate = f"{get_column_letter(column)}{row}"
+            anchor = self.create_safe_anchor(row, column, final_width_px, final_height_px)
+            if not anchor:
+                print(f"  [FAIL] 锚点创建失败: {coordinate}")
+                continue
+            
+            index = len(drawing.oneCellAnchor) + 1
+            anchor.pic = drawing._picture_frame(index)
+            drawing.oneCellAnchor.append(anchor)
+            media.append((f'rId{index}', f'xl/{image_path}', None))
+            anchored_cells.add((row, column))
+            print(f"  [OK] 成功修复: {coordinate} -> {final_width_px}x{final_height_px}")
+        
+        tree = drawing.to_tree()
+        tree.set('xmlns', SHEET_DRAWING_NS)
+        return tostring(tree), media, anchored_cells
+    
+    def _render_sheets_sharded(self, sheet_tasks, image_mapping, max_workers=None):
+        """按工作表分片，在多个进程中并行计算图片方案并生成各工作表的绘图部件"""
+        print(f"\n正在按工作表分片并行处理 {len(sheet_tasks)} 个工作表...")
+        sheet_drawings = {}
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = {}
+            for sheet_name, tasks in sheet_tasks.items():
+                # 每个分片只携带本工作表用到的映射条目
+                shard_mapping = {task[2]: image_mapping[task[2]]
+                                 for task in tasks if task[2] in image_mapping}
+                futures[sheet_name] = executor.submit(
+                    _render_sheet_shard, self.xlsx_file_path, tasks, shard_mapping)
+            
+            # 按原工作表顺序合并分片结果，保证输出中部件编号的顺序稳定
+            for sheet_name, future in futures.items():
+                try:
+                    sheet_drawings[sheet_name] = future.result()
+                    print(f"  工作表 {sheet_name}: 分片完成，{len(sheet_drawings[sheet_name][1])} 张图片")
+                except Exception as e:
+                    print(f"  工作表 {sheet_name} 分片处理失败，改为在主进程中处理: {e}")
+                    sheet_drawings[sheet_name] = self._render_sheet_drawing(
+                        self._plan_sheet_images(sheet_tasks[sheet_name], image_mapping))
+        return sheet_drawings
+    
+    @staticmethod
+    def _can_attach_drawing(sheet):
+        """工作表自带图片或图表时openpyxl会生成它自己的绘图部件，无法再挂预先生成的绘图"""
+        return not (sheet._images or sheet._charts)
+    
+    def _clear_anchored_cells(self, sheet, cell_table, start, stop, anchored_cells):
+        """清除已由预先生成的绘图覆盖的DISPIMG公式，返回清除的单元格数量"""
+        cleared_cells = 0
+        for row, column, _ in cell_table.records(start, stop):
+            if (row, column) in anchored_cells:
+                sheet.cell(row=row, column=column).value = None
+                cleared_cells += 1
+        return cleared_cells
+    
+    def _apply_sheet_images(self, sheet, plans):
+        """将图片方案写入工作表：清除公式并插入原生图片，返回成功数量"""
+        successful_fixes = 0
+        for row, column, image_id, image_path, final_width_px, final_height_px, image_data in plans:
+            cell = sheet.cell(row=row, column=column)
+            coordinate = cell.coordinate
+            original_value = cell.value
+            try:
+                # 清除原始公式
+                cell.value = None
+                
+                # 创建图片对象
+                img = OpenpyxlImage(io.BytesIO(image_data))
+                img.width = final_width_px
+                img.height = final_height_px
+                
+                # 创建安全锚点
+                anchor = self.create_safe_anchor(row, column, final_width_px, final_height_px)
+                if anchor:
+                    img.anchor = anchor
+                    sheet.add_image(img)
+                    
+                    successful_fixes += 1
+                    print(f"  [OK] 成功修复: {coordinate} -> {final_width_px}x{final_height_px}")
+                else:
+                    print(f"  [FAIL] 锚点创建失败: {coordinate}")
+                    
+            except Exception as e:
+                print(f"  [FAIL] 修复失败: {coordinate} - {str(e)}")
+                cell.value = original_value
+        return successful_fixes
+    
+    def _apply_richdata_cells(self, cell_table, image_mapping):
+        """把DISPIMG单元格改为单元格内图片，同一图片只生成一条共享记录
+        
+        返回(成功数量, {工作表名: {坐标: vm序号}}, 按记录顺序排列的图片路径)。
+        """
+        successful_fixes = 0
+        rich_cells = {}
+        rich_images = []
+        image_vms = {}
+        reader = self._get_reader()
+        
+        for sheet_name, start, stop in cell_table.sheets():
+            print(f"\n正在处理工作表: {sheet_name}")
+            sheet = self.workbook[sheet_name]
+            cell_vms = {}
+            for row, column, image_id in cell_table.records(start, stop):
+                cell = sheet.cell(row=row, column=column)
+                if image_id not in image_mapping:
+                    print(f"  [FAIL] 未找到图片映射: {image_id}")
+                    continue
+                image_path = image_mapping[image_id]
+                if f'xl/{image_path}' not in reader:
+                    print(f"  [FAIL] 无法提取图片数据: {image_id}")
+                    continue
+                    
+                vm = image_vms.get(image_path)
+                if vm is None:
+                    rich_images.append(image_path)
+                    vm = image_vms[image_path] = len(rich_images)
+                
+                # 单元格内图片以#VALUE!错误值占位，实际显示由vm引用的图片决定
+                cell.value = '#VALUE!'
+                cell_vms[cell.coordinate] = vm
+                successful_fixes += 1
+                print(f"  [OK] 成功修复: {cell.coordinate} -> 单元格内图片 #{vm}")
+            if cell_vms:
+                rich_cells[sheet_name] = cell_vms
+                
+        return successful_fixes, rich_cells, rich_images
+    
+    def _sheet_fingerprints(self, cell_table, image_mapping):
+        """计算每个含DISPIMG工作表的指纹：工作表XML哈希加上它用到的映射条目及图片CRC"""
+        reader = self._get_reader()
+        sheet_parts = _sheet_part_paths(reader)
+        fingerprints = {}
+        for sheet_name, start, stop in cell_table.sheets():
+            if sheet_name not in sheet_parts:
+                continue
+            digest = hashlib.sha256()
+            for chunk in reader.iter_chunks(sheet_parts[sheet_name]):
+                digest.update(chunk)
+            for image_id in sorted({image_id for _, _, image_id in cell_table.records(start, stop)}):
+                image_path = image_mapping.get(image_id, '')
+                media_name = f'xl/{image_path}'
+                crc = reader.getinfo(media_name).CRC if image_path and media_name in reader else 0
+                digest.update(f'\0{image_id}\0{image_path}\0{crc:08x}'.encode('utf-8'))
+            fingerprints[sheet_name] = digest.hexdigest()
+        return fingerprints
+    
+    @staticmethod
+    def _fingerprint_path(output_path):
+        """输出文件旁的指纹记录路径"""
+        return os.fspath(output_path) + FINGERPRINT_SUFFIX
+    
+    def _remove_fingerprints(self, output_path):
+        """保存前删除旧指纹，避免保存失败或非增量输出后旧指纹与新输出错配"""
+        try:
+            os.remove(self._fingerprint_path(output_path))
+        except FileNotFoundError:
+            pass
+    
+    def _write_fingerprints(self, output_path, output_mode, fingerprints):
+        """在输出文件旁记录本次的工作表指纹，供下次增量修复对比
+        
+        先写入同目录下的临时文件再替换，中途失败时不会留下不完整的指纹记录。
+        """
+        fingerprint_path = self._fingerprint_path(output_path)
+        temp_path = f'{fingerprint_path}.{os.getpid()}.tmp'
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump({'version': FINGERPRINT_VERSION, 'output_mode': output_mode,
+                           'sheets': fingerprints}, f, ensure_ascii=False, indent=2)
+            os.replace(temp_path, fingerprint_path)
+        except OSError as e:
+            print(f"写入指纹记录时出错: {e}")
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+    
+    def _read_previous_drawing(self, previous_output, sheet_part, media_cache):
+        """读出上次输出中某工作表的绘图部件，只复用全部由图片组成的绘图
+        
+        media_cache由_previous_media使用，同一图片在所有复用工作表间只保留一份。
+        返回(绘图XML, [(关系ID, 图片部件名, 图片数据)], {(行, 列)})，无法复用时返回None。
+        """
+        if sheet_part is None:
+            return None
+        drawing_parts = [target for _, rel_type, target in _read_relationships(previous_output, sheet_part)
+                         if rel_type == DRAWING_REL_TYPE]
+        if len(drawing_parts) != 1 or drawing_parts[0] not in previous_output:
+            return None
+        drawing_part = drawing_parts[0]
+        
+        media = []
+        for rel_id, rel_type, target in _read_relationships(previous_output, drawing_part):
+            if rel_type != IMAGE_REL_TYPE or target not in previous_output:
+                return None
+            media.append((rel_id, *self._previous_media(previous_output, target, media_cache)))
+        drawing_xml = bytes(previous_output.read(drawing_part))
+        
+        # 锚点所在单元格即上次成功修复的单元格
+        xdr = '{http://schemas.openxmlformats.org/drawingml/2006/spreadsheetDrawing}'
+        anchored_cells = {
+            (int(marker.find(f'{xdr}row').text) + 1, int(marker.find(f'{xdr}col').text) + 1)
+            for marker in ET.fromstring(drawing_xml).iter(f'{xdr}from')
+        }
+        return drawing_xml, media, anchored_cells
+    
+    def _previous_media(self, previous_output, target, media_cache):
+        """读取上次输出中的图片，内容相同的图片（openpyxl按单元格各写一份）只保留一份
+        
+        media_cache为{(CRC, 大小): [(图片部件名, 代表部件名, 图片数据)]}，返回(代表部件名, 图片数据)。
+        """
+        info = previous_output.getinfo(target)
+        entries = media_cache.setdefault((info.CRC, info.file_size), [])
+        for name, canonical, data in entries:
+            if name == target:
+                return canonical, data
+        
+        # 复制出来，之后上次的输出文件会被覆盖
+        data = bytes(previous_output.read(target))
+        canonical = target
+        for _, cached_canonical, cached_data in entries:
+            if cached_data == data:
+                canonical, data = cached_canonical, cached_data
+                break
+        entries.append((target, canonical, data))
+        return canonical, data
+    
+    def _load_reusable_drawings(self, output_path, fingerprints):
+        """对比上次输出旁的指纹，读出指纹未变工作表的绘图部件，返回{工作表名: 绘图}"""
+        fingerprint_path = self._fingerprint_path(output_path)
+        if not (os.path.exists(output_path) and os.path.exists(fingerprint_path)):
+            print("未找到上次的输出或指纹记录，执行完整修复")
+            return {}
+        try:
+            with open(fingerprint_path, 'r', encoding='utf-8') as f:
+                previous = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"读取指纹记录时出错，执行完整修复: {e}")
+            return {}
+        if (previous.get('version') != FINGERPRINT_VERSION or
+                previous.get('output_mode') != self.OUTPUT_MODE_DRAWING):
+            print("指纹记录的版本或输出模式不一致，执行完整修复")
+            return {}
+        
+        previous_sheets = previous.get('sheets', {})
+        reused = {}
+        media_cache = {}
+        try:
+            with MappedXlsxReader(output_path) as previous_output:
+                sheet_parts = _sheet_part_paths(previous_output)
+                for sheet_name, fingerprint in fingerprints.items():
+                    if previous_sheets.get(sheet_name) != fingerprint:
+                        continue
+                    if not self._can_attach_drawing(self.workbook[sheet_name]):
+                        continue
+                    drawing = self._read_previous_drawing(
+                        previous_output, sheet_parts.get(sheet_name), media_cache)
+                    if drawing:
+                        reused[sheet_name] = drawing
+        except Exception as e:
+            print(f"读取上次输出时出错，执行完整修复: {e}")
+            return {}
+        
+        print(f"增量修复: {len(reused)}/{len(fingerprints)} 个工作表未变化，复用上次结果")
+        return reused
+    
+    def fix_excel_file_precise_safe(self, output_path=None, shard_sheets=False, max_workers=None,
+                                    output_mode=OUTPUT_MODE_DRAWING, incremental=False):
+        """精确且安全的修复Excel文件
+        
+        output_path可以是文件路径或可写的二进制流；为None时写到源文件旁的<name>_fixed.xlsx
+        （仅源为文件路径时可用）。成功时返回output_path，否则返回None。
+        shard_sheets为True时，每个工作表作为独立分片在子进程中计算并生成绘图部件，
+        主进程只负责合并保存，max_workers限制进程数（默认为CPU核数）。
+        output_mode为'drawing'时生成浮动图片，为'richdata'时生成Excel单元格内图片。
+        incremental为True时，与上次输出旁记录的指纹（<输出文件>.fingerprint.json）对比，
+        未变化的工作表直接复用上次的绘图部件，保存成功后再记录本次的指纹
+        （仅支持drawing模式且输出为文件路径）。
+        """
+        try:
+            return self._fix_excel_file(output_path, shard_sheets, max_workers, output_mode, incremental)
+        finally:
+            self.close()
+    
+    def _fix_excel_file(self, output_path, shard_sheets, max_workers, output_mode, incremental):
+        """修复流程主体，源文件映射由调用方负责释放"""
+        if output_mode not in self.OUTPUT_MODES:
+            print(f"不支持的输出模式: {output_mode}")
+            return None
+            
         if output_path is None:
-            output_path = self.xlsx_file_path.replace('.xlsx', '_fixed.xlsx')  # 统一使用_fixed后缀
+            if self.xlsx_file_path is None:
+                print("源数据不是文件路径，必须指定输出路径或输出流")
+                return None
+            output_path = self.default_output_path(self.xlsx_file_path)  # 统一使用_fixed后缀
+        output_is_path = isinstance(output_path, (str, os.PathLike))
+        output_name = output_path if output_is_path else "<输出流>"
         
         print("=== 精确安全WPS图片修复工具 ===")
         print("正在分析所有工作表中的DISPIMG单元格...")
         
-        all_dispimg_cells = self.analyze_dispimg_cells()
-        if not all_dispimg_cells:
+        cell_table = self.analyze_dispimg_cells()
+        if not cell_table:
             print("未发现需要修复的DISPIMG公式")
             return
             
-        total_cells = sum(len(cells) for cells in all_dispimg_cells.values())
+        total_cells = len(cell_table)
         print(f"总共发现 {total_cells} 个DISPIMG公式需要修复")
         
         print("正在获取图片映射关系...")
@@ -270,60 +1200,63 @@ class PreciseSafeWPSExcelFixer:
         
         successful_fixes = 0
         
-        for sheet_name, dispimg_cells in all_dispimg_cells.items():
+        sheet_spans = cell_table.sheets()
+        rich_cells = rich_images = None
+        
+        # 指纹只在增量修复时计算，且只能记录在输出文件旁
+        fingerprints = None
+        reused = {}
+        if incremental:
+            if output_mode != self.OUTPUT_MODE_DRAWING or not output_is_path:
+                print("增量修复仅支持drawing模式且输出为文件路径，执行完整修复")
+            else:
+                fingerprints = self._sheet_fingerprints(cell_table, image_mapping)
+                reused = self._load_reusable_drawings(output_path, fingerprints)
+        
+        # 保存时直接挂到工作表上的预先生成的绘图：增量复用的上次结果和分片子进程的结果
+        attached_drawings = {}
+        if reused:
+            for sheet_name, start, stop in sheet_spans:
+                if sheet_name in reused:
+                    print(f"\n复用工作表: {sheet_name}")
+                    reused_cells = self._clear_anchored_cells(
+                        self.workbook[sheet_name], cell_table, start, stop, reused[sheet_name][2])
+                    print(f"  [REUSE] 复用上次结果: {reused_cells} 个单元格")
+                    successful_fixes += reused_cells
+            attached_drawings.update(reused)
+            sheet_spans = [span for span in sheet_spans if span[0] not in reused]
+        
+        if shard_sheets and self.xlsx_file_path is None:
+            print("源数据不是文件路径，分片子进程无法独立读取，改为在主进程中处理")
+            shard_sheets = False
+        
+        if output_mode == self.OUTPUT_MODE_RICHDATA:
+            # 单元格内图片无需计算尺寸，也就不需要分片
+            successful_fixes, rich_cells, rich_images = self._apply_richdata_cells(
+                cell_table, image_mapping)
+            sheet_spans = []
+        elif shard_sheets and len(sheet_spans) > 1:
+            # 分片需要可序列化的任务列表：单元格尺寸依赖工作表对象，在主进程中计算
+            shard_spans = [span for span in sheet_spans if self._can_attach_drawing(self.workbook[span[0]])]
+            sheet_tasks = {
+                sheet_name: list(self._iter_sheet_tasks(self.workbook[sheet_name], cell_table, start, stop))
+                for sheet_name, start, stop in shard_spans
+            }
+            sheet_drawings = self._render_sheets_sharded(sheet_tasks, image_mapping, max_workers)
+            for sheet_name, start, stop in shard_spans:
+                successful_fixes += self._clear_anchored_cells(
+                    self.workbook[sheet_name], cell_table, start, stop, sheet_drawings[sheet_name][2])
+            attached_drawings.update(sheet_drawings)
+            # 自带图片或图表的工作表仍交给openpyxl，在下面逐条处理
+            sheet_spans = [span for span in sheet_spans if span[0] not in sheet_drawings]
+        
+        # 单进程模式下任务和方案逐条流过各阶段，不生成中间列表
+        for sheet_name, start, stop in sheet_spans:
             print(f"\n正在处理工作表: {sheet_name}")
             sheet = self.workbook[sheet_name]
-            
-            for cell_info in dispimg_cells:
-                image_id = cell_info['image_id']
-                cell = cell_info['cell']
-                
-                if image_id in image_mapping:
-                    image_path = image_mapping[image_id]
-                    print(f"\n  正在处理图片: {image_id}")
-                    
-                    image_data = self.extract_image_from_xlsx(image_path)
-                    if image_data:
-                        try:
-                            # 获取图片原始尺寸
-                            img_stream = io.BytesIO(image_data)
-                            with PILImage.open(img_stream) as pil_img:
-                                original_width, original_height = pil_img.size
-                            
-                            # 获取精确单元格尺寸
-                            cell_width_px, cell_height_px = self.get_precise_cell_dimensions(sheet, cell_info)
-                            
-                            # 计算精确缩放
-                            final_width_px, final_height_px = self.calculate_proper_scaling(
-                                cell_width_px, cell_height_px, original_width, original_height)
-                            
-                            # 清除原始公式
-                            cell.value = None
-                            
-                            # 创建图片对象
-                            img_stream.seek(0)
-                            img = OpenpyxlImage(img_stream)
-                            img.width = final_width_px
-                            img.height = final_height_px
-                            
-                            # 创建安全锚点
-                            anchor = self.create_safe_anchor(cell_info, final_width_px, final_height_px)
-                            if anchor:
-                                img.anchor = anchor
-                                sheet.add_image(img)
-                                
-                                successful_fixes += 1
-                                print(f"  [OK] 成功修复: {cell.coordinate} -> {final_width_px}x{final_height_px}")
-                            else:
-                                print(f"  [FAIL] 锚点创建失败: {cell.coordinate}")
-                                
-                        except Exception as e:
-                            print(f"  [FAIL] 修复失败: {cell.coordinate} - {str(e)}")
-                            cell.value = f'=_xlfn.DISPIMG("{image_id}")'
-                    else:
-                        print(f"  [FAIL] 无法提取图片数据: {image_id}")
-                else:
-                    print(f"  [FAIL] 未找到图片映射: {image_id}")
+            tasks = self._iter_sheet_tasks(sheet, cell_table, start, stop)
+            plans = self._plan_sheet_images(tasks, image_mapping)
+            successful_fixes += self._apply_sheet_images(sheet, plans)
         
         # 清理兼容性设置
         print("\n正在清理兼容性设置...")
@@ -335,42 +1268,93 @@ class PreciseSafeWPSExcelFixer:
             print(f"清理兼容性设置时出错: {e}")
         
         # 保存文件
-        print(f"正在保存修复后的文件到: {output_path}")
+        print(f"正在保存修复后的文件到: {output_name}")
+        # 原地修复时保存过程中还要从源文件的映射读取图片，不能先截断它：
+        # 先写到同目录的临时文件，释放映射后再替换
+        in_place = output_is_path and self._is_source_file(output_path)
+        save_path = f'{os.fspath(output_path)}.{os.getpid()}.tmp' if in_place else output_path
         try:
-            self.workbook.save(output_path)
+            # 输出文件即将被覆盖，旧指纹随之失效；新指纹在保存成功后才写入
+            if output_is_path:
+                self._remove_fingerprints(output_path)
+            _save_workbook(self.workbook, save_path, attached_drawings, self._get_reader(),
+                           rich_cells, rich_images)
+            if in_place:
+                self.close()
+                os.replace(save_path, output_path)
+            if fingerprints is not None:
+                self._write_fingerprints(output_path, output_mode, fingerprints)
             print(f"\n[COMPLETE] 修复完成!")
             print(f"总计处理: {total_cells} 个DISPIMG公式")
             print(f"成功修复: {successful_fixes} 个")
-            print(f"输出文件: {output_path}")
+            print(f"输出文件: {output_name}")
             return output_path
             
         except Exception as e:
             print(f"保存文件时出错: {e}")
+            if in_place and os.path.exists(save_path):
+                os.remove(save_path)
             return None
     
     def preview_fixes(self):
         """预览将要修复的内容"""
+        try:
+            self._preview_fixes()
+        finally:
+            self.close()
+    
+    def _preview_fixes(self):
+        """预览流程主体"""
         print("=== 预览修复内容 ===")
-        all_dispimg_cells = self.analyze_dispimg_cells()
+        cell_table = self.analyze_dispimg_cells()
         
-        if not all_dispimg_cells:
+        if not cell_table:
             print("未发现需要修复的内容")
             return
             
         image_mapping = self.get_image_mapping()
         
-        total = 0
-        for sheet_name, cells in all_dispimg_cells.items():
+        for sheet_name, start, stop in cell_table.sheets():
             print(f"\n工作表 '{sheet_name}':")
-            for cell_info in cells:
-                image_id = cell_info['image_id']
+            for row, column, image_id in cell_table.records(start, stop):
+                coordinate = f"{get_column_letter(column)}{row}"
                 if image_id in image_mapping:
-                    print(f"  {cell_info['coordinate']}: {image_id} -> {image_mapping[image_id]}")
+                    print(f"  {coordinate}: {image_id} -> {image_mapping[image_id]}")
                 else:
-                    print(f"  {cell_info['coordinate']}: {image_id} (图片映射缺失)")
-                total += 1
+                    print(f"  {coordinate}: {image_id} (图片映射缺失)")
         
-        print(f"\n总计发现 {total} 个需要修复的图片")
+        print(f"\n总计发现 {len(cell_table)} 个需要修复的图片")
+
+
+def repair_xlsx_bytes(source, output_mode=PreciseSafeWPSExcelFixer.OUTPUT_MODE_DRAWING):
+    """在内存中完成修复：source为xlsx的bytes或可读文件对象，返回修复后的bytes
+
+    没有需要修复的DISPIMG公式时原样返回输入内容；无法加载或修复失败时抛出RuntimeError。
+    需要直接写入响应流时，可将可写流作为output_path传给fix_excel_file_precise_safe。
+    """
+    if hasattr(source, 'read') and not source.seekable():
+        # 无法回退的流先读入内存，无需修复时才能原样返回
+        source = source.read()
+    output = io.BytesIO()
+    fixer = PreciseSafeWPSExcelFixer(source)
+    if fixer.fix_excel_file_precise_safe(output, output_mode=output_mode) is not None:
+        return output.getvalue()
+    if fixer.dispimg_cell_count != 0:
+        raise RuntimeError("修复失败，详细原因见输出日志")
+    
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return bytes(source)
+    source.seek(0)
+    return source.read()
+
+
+def _render_sheet_shard(xlsx_file_path, tasks, image_mapping):
+    """子进程入口：独立映射源文件，计算一个工作表分片的图片方案并生成它的绘图部件"""
+    fixer = PreciseSafeWPSExcelFixer(xlsx_file_path)
+    try:
+        return fixer._render_sheet_drawing(fixer._plan_sheet_images(tasks, image_mapping))
+    finally:
+        fixer.close()
 
 
 def main():
@@ -388,6 +1372,7 @@ import tkinter as tk
 from tkinter import ttk, messagebox
 import os
 import threading
+import multiprocessing
 import time
 import sys
 from pathlib import Path
@@ -397,8 +1382,12 @@ from pathlib import Path
 
 class ProgressWindow:
     """现代化进度窗口类"""
-    def __init__(self, file_path):
+    def __init__(self, file_path, shard_sheets=False, output_mode=PreciseSafeWPSExcelFixer.OUTPUT_MODE_DRAWING,
+                 incremental=False):
         self.file_path = file_path
+        self.shard_sheets = shard_sheets
+        self.output_mode = output_mode
+        self.incremental = incremental
         self.repaired_file = None
         
         # 创建进度窗口
@@ -647,14 +1636,16 @@ class ProgressWindow:
             fixer = PreciseSafeWPSExcelFixer(self.file_path)
             
             # 设置输出路径 - 确保文件名统一
-            output_path = self.file_path.replace('.xlsx', '_fixed.xlsx')
+            output_path = PreciseSafeWPSExcelFixer.default_output_path(self.file_path)
             
             # 直接调用核心修复方法
             self.update_progress(10, "正在执行修复...")
             
             try:
                 # 只调用一次修复方法，避免重复
-                result = fixer.fix_excel_file_precise_safe(output_path)
+                result = fixer.fix_excel_file_precise_safe(
+                    output_path, shard_sheets=self.shard_sheets, output_mode=self.output_mode,
+                    incremental=self.incremental)
                 
                 if result and os.path.exists(result):
                     self.repaired_file = result
@@ -694,9 +1685,28 @@ class ProgressWindow:
 
 def main():
     """主函数"""
-    if len(sys.argv) > 1:
+    # 打包后的EXE在子进程中处理工作表分片时需要
+    multiprocessing.freeze_support()
+    
+    # --shard: 按工作表分片，多进程并行处理
+    # --mode=richdata: 生成Excel单元格内图片，默认--mode=drawing生成浮动图片
+    # --incremental: 只重新处理相对上次输出发生变化的工作表
+    options = [arg for arg in sys.argv[1:] if arg.startswith('--')]
+    file_args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    shard_sheets = '--shard' in options
+    incremental = '--incremental' in options
+    output_mode = PreciseSafeWPSExcelFixer.OUTPUT_MODE_DRAWING
+    for option in options:
+        if option.startswith('--mode='):
+            output_mode = option.split('=', 1)[1]
+    
+    if output_mode not in PreciseSafeWPSExcelFixer.OUTPUT_MODES:
+        messagebox.showerror("错误", f"不支持的输出模式: {output_mode}")
+        return
+    
+    if file_args:
         # 处理拖拽的文件
-        file_path = sys.argv[1]
+        file_path = file_args[0]
         
         if not os.path.exists(file_path):
             messagebox.showerror("错误", f"文件不存在: {file_path}")
@@ -707,7 +1717,8 @@ def main():
             return
         
         # 启动进度窗口
-        progress = ProgressWindow(file_path)
+        progress = ProgressWindow(file_path, shard_sheets=shard_sheets, output_mode=output_mode,
+                                  incremental=incremental)
         progress.run()
     else:
         # 显示使用说明